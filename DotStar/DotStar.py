@@ -5,27 +5,49 @@ This main module contains the core of DotStar
 # IMPORTS
 import sys
 import os
-import random
 import tempfile
 import zipfile
 import zlib
+import mmap
 import logging
 import shutil
 import struct
 import platform
 import subprocess
+import asyncio
+import signal
+import threading
+import concurrent.futures
+import socketserver
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from distutils.version import StrictVersion
 import argparse
 import re
 import requests
 import hashlib
+import json
+import contextlib
+import errno
+import ctypes
+import queue
+import time
 import yaml
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 
 # INFO
 __version__ = "0.1.2"
 
 # CONSTANTS
 PACKAGE_INFO_FILE = "Package.yml"
+PACKAGE_HASH_FILE = "Package.sha256"
 
 # From https://stackoverflow.com/questions/404744/determining-application-path-in-a-python-exe-generated-by-pyinstaller#404750
 # determine if application is a script file or frozen exe
@@ -38,9 +60,19 @@ SETTINGS_FILE = os.path.join(WORKING_DIRECTORY, "DotStarSettings.yml")
 PACKAGES_DIRECTORY = os.path.join(WORKING_DIRECTORY, "Packages")
 PACKAGE_CACHE_DIRECTORY = os.path.join(PACKAGES_DIRECTORY, "Cache")
 INSTALLED_FILES_DIRECTORY = os.path.join(PACKAGES_DIRECTORY, "Installed")
+EXTRACTION_CACHE_DIRECTORY = os.path.join(PACKAGES_DIRECTORY, "Extracted")
+FILE_HASHES_DIRECTORY = os.path.join(PACKAGES_DIRECTORY, "Hashes")
+STAGING_DIRECTORY = os.path.join(PACKAGES_DIRECTORY, "Staging")
+LOCKS_DIRECTORY = os.path.join(PACKAGES_DIRECTORY, "Locks")
+LOGS_DIRECTORY = os.path.join(PACKAGES_DIRECTORY, "Logs")
+TRASH_DIRECTORY = os.path.join(PACKAGES_DIRECTORY, "Trash")
 REPO_DIRECTORY = os.path.join(WORKING_DIRECTORY, "Repositories")
 
 CURRENT_VERSION = StrictVersion(__version__)
+
+# The umask can only be read by setting it
+CURRENT_UMASK = os.umask(0o022)
+os.umask(CURRENT_UMASK)
 DEFAULT_SETTINGS = {
     "Repositories":
     [
@@ -59,12 +91,46 @@ DEFAULT_SETTINGS = {
         "Level": "debug"
     },
     "Locked files":
-    []
+    [],
+    "Temporary directory": None,
+    "Extraction cache":
+    {
+        "Enabled": True,
+        "Maximum size in MB": 1024
+    },
+    "Downloads":
+    {
+        "Segmented download threshold in MB": 64,
+        "Segment size in MB": 8,
+        "Connections": 8,
+        "Maximum wait for busy servers in seconds": 1800
+    },
+    "Scripts":
+    {
+        "Parallel jobs": 4,
+        "Timeout in seconds": 3600
+    },
+    "Sync":
+    {
+        "Parallel jobs": 8
+    },
+    "Mirror":
+    {
+        "Address": "0.0.0.0",
+        "Port": 8557,
+        "Wait for upstream in seconds": 5
+    }
 }
 
 # VARIABLES
 settings = None
 yes_to_all = False
+user_consent_lock = threading.Lock()
+script_slots = None
+script_slots_lock = threading.Lock()
+script_loop = None
+mirror_fetches_lock = threading.Lock()
+mirror_fetches_in_flight = {}
 
 def load_settings(settings_file=SETTINGS_FILE):
     """
@@ -74,7 +140,7 @@ def load_settings(settings_file=SETTINGS_FILE):
     global settings
     try:
         with open(settings_file) as settings_yaml:
-            settings = yaml.load(settings_yaml)
+            settings = yaml.safe_load(settings_yaml)
     except yaml.YAMLError:
         settings = DEFAULT_SETTINGS
     except FileNotFoundError:
@@ -84,13 +150,34 @@ def save_settings(settings_file=SETTINGS_FILE):
     """
     Save the settings into the Settings file.
     """
-    global settings
+    with file_lock(settings_file + ".lock"):
+        write_settings(settings_file)
+
+def write_settings(settings_file=SETTINGS_FILE):
+    """
+    Atomically replaces the Settings file with the
+    current settings. The caller has to hold the lock
+    of the Settings file.
+    """
     try:
-        with open(settings_file, 'w') as settings_yaml:
+        with atomic_write(settings_file, 'w') as settings_yaml:
             yaml.dump(settings, settings_yaml)
     except:
         logging.error("Couldn't update settings")
 
+@contextlib.contextmanager
+def settings_transaction(settings_file=SETTINGS_FILE):
+    """
+    Reloads the settings, lets the caller modify them and
+    saves them again, all while holding the lock of the
+    Settings file. Prevents losing changes made by other
+    DotStar processes in the meantime.
+    """
+    with file_lock(settings_file + ".lock"):
+        load_settings(settings_file)
+        yield
+        write_settings(settings_file)
+
 def get_current_platform():
     """
     Returns the current platform DotStar is
@@ -122,13 +209,15 @@ def user_consent(message):
     """
     if yes_to_all:
         return True
-    user_input = input(message)
-    while not (user_input == '' or
-               user_input == 'y' or
-               user_input == 'Y' or
-               user_input == 'n' or
-               user_input == 'N'):
-        user_input = input("Please provide a correct option: ")
+    # Packages may be processed in parallel, so ask one question at a time
+    with user_consent_lock:
+        user_input = input(message)
+        while not (user_input == '' or
+                   user_input == 'y' or
+                   user_input == 'Y' or
+                   user_input == 'n' or
+                   user_input == 'N'):
+            user_input = input("Please provide a correct option: ")
     if user_input == '' or user_input == 'y' or user_input == 'Y':
         return True
     return False
@@ -179,7 +268,13 @@ def open_file(input_name, action='0'):
     if os.path.isfile(input_name):
         local_file_path = os.path.realpath(input_name)
     elif is_url(input_name):
-        local_file_path = download_file(input_name, get_temporary_directory())
+        try:
+            local_file_path = download_file(input_name, get_temporary_directory())
+        except (requests.RequestException, IOError) as err:
+            logging.error("Couldn't download " + input_name + ": " + str(err))
+            return
+        if local_file_path is None:
+            return
     elif not input_name.endswith(".star"):
         # Check if the file is installed
         logging.info("Searching installed files for " + input_name)
@@ -205,9 +300,16 @@ def open_file(input_name, action='0'):
             if len(available_files) > 1:
                 pass
             else:
-                local_file_path = cache_retrieve_file(available_files[0]["URL"],
-                                                      available_files[0]["Name"],
-                                                      available_files[0]["Version"])
+                try:
+                    local_file_path = cache_retrieve_file(available_files[0]["URL"],
+                                                          available_files[0]["Name"],
+                                                          str(available_files[0]["Version"]),
+                                                          available_files[0].get("Mirrors"),
+                                                          available_files[0].get("Hash"),
+                                                          available_files[0].get("Fallbacks"))
+                except (requests.RequestException, IOError) as err:
+                    logging.error("Couldn't download " + input_name + ": " + str(err))
+                    return
     else:
         logging.info("File could not be found locally or in the repositories. Check " +
                      "your spelling.")
@@ -227,31 +329,31 @@ def open_file(input_name, action='0'):
 
     # Clean up if necessary
     if local_file_path.endswith("Temp.star"):
-        shutil.rmtree(os.path.dirname(local_file_path))
+        move_to_trash(os.path.dirname(local_file_path))
 
 def open_local_file_or_folder(file_or_dir_path, action='0'):
     """
     Opens a .star file which is on the local hard-drive
-    of the computer
+    of the computer. Returns whether the action succeeded.
     """
+    extraction = None
     try:
         if os.path.isfile(file_or_dir_path):
-            # Extract file to temporary directory
-            temp_dir = get_temporary_directory()
-            logging.debug("Extracting file to temporary directory " + temp_dir)
-            decompress_file(file_or_dir_path, temp_dir)
+            # Get the extracted file from the extraction cache
+            extraction = extraction_cache_checkout(file_or_dir_path)
+            temp_dir = extraction[0]
         elif os.path.isdir(file_or_dir_path):
             # Set this folder as our working directory
             temp_dir = file_or_dir_path
         else:
             logging.error("Path is whether file nor folder.")
-            return
+            return False
 
         # Process file
         package_info_file = os.path.join(temp_dir, PACKAGE_INFO_FILE)
         try:
             with open(package_info_file) as package_info_yaml:
-                data = yaml.load(package_info_yaml)
+                data = yaml.safe_load(package_info_yaml)
 
             # Check the "DotStar Information area"
             version_used_to_compile = StrictVersion(data["DotStar Information"]["Version"])
@@ -265,7 +367,7 @@ def open_local_file_or_folder(file_or_dir_path, action='0'):
             if "Integrity Information" in data:
                 if not verify_integrity(temp_dir, data["Integrity Information"]):
                     logging.error("Package corrupted.")
-                    return
+                    return False
 
             # Check the dependencies area
             if "Dependency Information" in data:
@@ -283,7 +385,7 @@ def open_local_file_or_folder(file_or_dir_path, action='0'):
                 if "Supported Platforms" in info:
                     if get_current_platform() not in info["Supported Platforms"]:
                         logging.critical("This app is currently not supported on this platform")
-                        return
+                        return False
 
                 # If no action is specified, let the user decide
                 if action == '0':
@@ -299,34 +401,58 @@ def open_local_file_or_folder(file_or_dir_path, action='0'):
                 if action == "Run":
                     # Run the app
                     # Select appropiate script, depending on platform
-                    select_additional_tasks(temp_dir, "Run")
+                    return script_succeeded(select_additional_tasks(temp_dir, "Run", info["Name"]))
 
                 elif action == "Install":
                     # Install the app
                     # Copy the temp_dir to the installation directory
                     installation_dir = os.path.join(INSTALLED_FILES_DIRECTORY,
                                                     info["Name"])
-                    if not os.path.exists(os.path.dirname(installation_dir)):
-                        os.makedirs(os.path.dirname(installation_dir))
-                    if os.path.exists(installation_dir):
-                        shutil.rmtree(installation_dir)
-                    shutil.copytree(temp_dir, installation_dir)
-
-                    # Additional installation steps
-                    select_additional_tasks(installation_dir, "Install")
+                    ignore = None
+                    if extraction is not None and extraction[1] is not None:
+                        # Run scripts may have added files to the cached tree
+                        ignore = extraction_cache_ignore_added_files(temp_dir)
+                    with package_lock(info["Name"]):
+                        # Private temporary extractions can be moved instead of copied
+                        install_directory(temp_dir, installation_dir,
+                                          move=extraction is not None and extraction[1] is None,
+                                          ignore=ignore)
+
+                        # Additional installation steps
+                        if not script_succeeded(select_additional_tasks(installation_dir,
+                                                                        "Install", info["Name"])):
+                            # Don't let sync take this for the pinned .star file
+                            set_installed_hash(info["Name"], None)
+                            logging.error("Installation of " + info["Name"] + " failed")
+                            return False
+
+                        # Remember which .star file is installed
+                        if os.path.isfile(file_or_dir_path):
+                            set_installed_hash(info["Name"],
+                                               get_cached_file_hash(file_or_dir_path))
+                        elif (os.path.realpath(file_or_dir_path) !=
+                              os.path.realpath(installation_dir)):
+                            set_installed_hash(info["Name"], None)
 
                     logging.info("Installation successful")
+                    return True
                 elif action == "Uninstall":
-                    # Additional uninstallation steps
-                    select_additional_tasks(temp_dir, "Uninstall")
-
-                    # Delete the file
-                    if os.path.isfile(file_or_dir_path):
-                        os.remove(file_or_dir_path)
-                        logging.info("Removed file " + file_or_dir_path)
-                    else:
-                        shutil.rmtree(file_or_dir_path)
-                        logging.info("Removed folder " + file_or_dir_path)
+                    with package_lock(info["Name"]):
+                        # Additional uninstallation steps
+                        if not script_succeeded(select_additional_tasks(temp_dir, "Uninstall",
+                                                                        info["Name"])):
+                            # Keep the files to be able to try again
+                            logging.error("Uninstallation of " + info["Name"] + " failed")
+                            return False
+
+                        # Delete the file
+                        if os.path.isfile(file_or_dir_path):
+                            os.remove(file_or_dir_path)
+                            logging.info("Removed file " + file_or_dir_path)
+                        else:
+                            remove_directory(file_or_dir_path)
+                            logging.info("Removed folder " + file_or_dir_path)
+                    return True
                 else:
                     logging.error("No action specified")
 
@@ -337,85 +463,214 @@ def open_local_file_or_folder(file_or_dir_path, action='0'):
             raise err
         except yaml.YAMLError:
             logging.critical("Error decoding YAML")
-
-        # If necessary, clean up the temporary directory
-        if os.path.isfile(file_or_dir_path):
-            shutil.rmtree(temp_dir)
-            logging.debug("Removed temporary directory " + temp_dir)
     except zipfile.BadZipFile:
         logging.critical("Bad zip file!")
     except FileNotFoundError as err:
         logging.critical("File doesn't exist! " + str(err))
+    finally:
+        # If necessary, release or clean up the extracted directory
+        if extraction is not None:
+            extraction_cache_checkin(*extraction)
+    return False
 
-def select_additional_tasks(folder_path, action):
+def select_additional_tasks(folder_path, action, package_name=None):
     """
-    Selects and runs additional steps
+    Selects and runs additional steps. Returns the result
+    of the script (see run_script_async) or None if no
+    script was run.
     """
-    current_platform = get_current_platform()
+    command = find_additional_task(folder_path, action)
+    if command is None:
+        return None
     user_consent_message = ("Additional supportive scripts for action '" + action +
                             "' were found. Run? (Y/n):")
+    if not user_consent(user_consent_message):
+        return None
+    if package_name is None:
+        package_name = os.path.basename(folder_path)
+    return run_scripts([{"command": command,
+                         "folder_path": folder_path,
+                         "package_name": package_name,
+                         "action": action}])[0]
+
+def script_succeeded(script_result):
+    """
+    Returns whether the result of select_additional_tasks
+    means success. Not running any script counts as success.
+    """
+    return script_result is None or script_result["Exit code"] == 0
+
+def find_additional_task(folder_path, action):
+    """
+    Returns the command running the most specific script
+    for the action on the current platform, or None if
+    there is no such script
+    """
+    current_platform = get_current_platform()
+    if current_platform in ("Win64", "Win32"):
+        candidates = []
+        for platform_name in (current_platform, "Win"):
+            script_name = "Package." + platform_name + "." + action
+            candidates.append((script_name + ".ps1", ["powershell.exe"]))
+            candidates.append((script_name + ".bat", []))
+    elif current_platform in ("Linux", "macOS"):
+        candidates = [("Package." + current_platform + "." + action + ".sh", ["bash"])]
+    else:
+        return None
+
+    for script_name, interpreter in candidates:
+        script_path = os.path.join(folder_path, script_name)
+        if os.path.exists(script_path):
+            return interpreter + [script_path]
+    return None
+
+def get_script_slots():
+    """
+    Returns the semaphore limiting how many
+    scripts run at the same time
+    """
+    global script_slots
+    with script_slots_lock:
+        if script_slots is None:
+            script_settings = settings.get("Scripts", DEFAULT_SETTINGS["Scripts"])
+            script_slots = threading.BoundedSemaphore(script_settings["Parallel jobs"])
+    return script_slots
 
-    if current_platform.startswith("Win64"):
-        # The script created specifically for this action
-        package_file_specific_64 = os.path.join(folder_path, "Package.Win64." + action + ".bat")
-        package_file_specific_64_posh = os.path.join(folder_path, "Package.Win64." + action + ".ps1")
-        package_file_specific = os.path.join(folder_path, "Package.Win." + action + ".bat")
-        package_file_specific_posh = os.path.join(folder_path, "Package.Win." + action + ".ps1")
-
-        if os.path.exists(package_file_specific_64_posh):
-            if user_consent(user_consent_message):
-                subprocess.call(["powershell.exe", package_file_specific_64_posh], cwd=folder_path)
-
-        elif os.path.exists(package_file_specific_64):
-            if user_consent(user_consent_message):
-                subprocess.call([package_file_specific_64], cwd=folder_path)
-
-        elif os.path.exists(package_file_specific_posh):
-            if user_consent(user_consent_message):
-                subprocess.call(["powershell.exe", package_file_specific_posh], cwd=folder_path)
-
-        elif os.path.exists(package_file_specific):
-            if user_consent(user_consent_message):
-                subprocess.call([package_file_specific], cwd=folder_path)
-
-    elif current_platform.startswith("Win32"):
-        # The script created specifically for this action
-        package_file_specific_32 = os.path.join(folder_path, "Package.Win32." + action + ".bat")
-        package_file_specific_32_posh = os.path.join(folder_path, "Package.Win32." + action + ".ps1")
-        package_file_specific = os.path.join(folder_path, "Package.Win." + action + ".bat")
-        package_file_specific_posh = os.path.join(folder_path, "Package.Win." + action + ".ps1")
-
-        if os.path.exists(package_file_specific_32_posh):
-            if user_consent(user_consent_message):
-                subprocess.call(["powershell.exe", package_file_specific_32_posh], cwd=folder_path)
-
-        elif os.path.exists(package_file_specific_32):
-            if user_consent(user_consent_message):
-                subprocess.call([package_file_specific_32], cwd=folder_path)
-
-        elif os.path.exists(package_file_specific_posh):
-            if user_consent(user_consent_message):
-                subprocess.call(["powershell.exe", package_file_specific_posh], cwd=folder_path)
-                
-        elif os.path.exists(package_file_specific):
-            if user_consent(user_consent_message):
-                subprocess.call([package_file_specific], cwd=folder_path)
-
-    elif current_platform.startswith("Linux"):
-        # The script created specifically for this action
-        package_file_specific = os.path.join(folder_path, "Package.Linux." + action + ".sh")
-
-        if os.path.exists(package_file_specific):
-            if user_consent(user_consent_message):
-                subprocess.call(["bash", package_file_specific], cwd=folder_path)
-
-    elif current_platform.startswith("macOS"):
-        # The script created specifically for this action
-        package_file_specific = os.path.join(folder_path, "Package.macOS." + action + ".sh")
-
-        if os.path.exists(package_file_specific):
-            if user_consent(user_consent_message):
-                subprocess.call(["bash", package_file_specific], cwd=folder_path)
+def new_script_loop():
+    """
+    Returns a new event loop which can run subprocesses
+    """
+    if sys.platform == "win32":
+        return asyncio.ProactorEventLoop()
+    return asyncio.new_event_loop()
+
+def run_scripts(jobs):
+    """
+    Runs the scripts described by jobs (keyword arguments
+    of run_script_async) concurrently and returns their
+    results in the same order. Worker threads hand their
+    scripts to the main thread's loop, because before
+    Python 3.8 subprocesses only work there.
+    """
+    async def run_all():
+        return await asyncio.gather(*[run_script_async(**job) for job in jobs])
+
+    if script_loop is not None and threading.current_thread() is not threading.main_thread():
+        return asyncio.run_coroutine_threadsafe(run_all(), script_loop).result()
+    loop = new_script_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(run_all())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+def run_in_worker_threads(calls, max_workers):
+    """
+    Runs the calls (function and argument tuples) in
+    a thread pool and returns their results in the same
+    order. Meanwhile the main thread runs the loop which
+    the workers' package scripts are run on.
+    """
+    global script_loop
+    loop = new_script_loop()
+    asyncio.set_event_loop(loop)
+    script_loop = loop
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = [executor.submit(function, *arguments) for function, arguments in calls]
+            if futures:
+                loop.run_until_complete(asyncio.gather(
+                    *[asyncio.wrap_future(future) for future in futures],
+                    return_exceptions=True))
+            return [future.result() for future in futures]
+    finally:
+        script_loop = None
+        asyncio.set_event_loop(None)
+        loop.close()
+
+async def run_script_async(command, folder_path, package_name, action):
+    """
+    Runs a package script once a script slot is free and returns
+    a dict with its exit code (None on timeout) and duration.
+    Except for Run scripts, which keep the terminal, the output
+    is captured into the package's log and stopped after
+    the configured timeout.
+    """
+    script_settings = settings.get("Scripts", DEFAULT_SETTINGS["Scripts"])
+    interactive = action == "Run"
+    timeout = None if interactive else (script_settings["Timeout in seconds"] or None)
+    slots = get_script_slots()
+    await asyncio.get_event_loop().run_in_executor(None, slots.acquire)
+    try:
+        if not os.path.exists(LOGS_DIRECTORY):
+            os.makedirs(LOGS_DIRECTORY, exist_ok=True)
+        log_path = os.path.join(LOGS_DIRECTORY, package_name + ".log")
+        with open(log_path, "a", encoding="utf-8") as log_file:
+            log_file.write("=== " + action + " " + time.strftime("%Y-%m-%d %H:%M:%S") +
+                           ": " + " ".join(command) + "\n")
+            begin = time.monotonic()
+            output = None if interactive else asyncio.subprocess.PIPE
+            process = await asyncio.create_subprocess_exec(
+                *command, cwd=folder_path, stdout=output, stderr=output,
+                limit=1024 * 1024, start_new_session=not interactive and os.name == "posix")
+            tasks = [process.wait()]
+            if not interactive:
+                tasks.append(pump_script_output(process.stdout, sys.stdout, log_file, package_name))
+                tasks.append(pump_script_output(process.stderr, sys.stderr, log_file, package_name))
+            try:
+                await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+                exit_code = process.returncode
+            except asyncio.TimeoutError:
+                kill_script(process)
+                await process.wait()
+                exit_code = None
+            duration = time.monotonic() - begin
+            log_file.write("=== Exit code " + str(exit_code) + " after %.2f s\n" % duration)
+    finally:
+        slots.release()
+
+    script_name = os.path.basename(command[-1])
+    if exit_code is None:
+        logging.error(script_name + " of " + package_name + " timed out after " +
+                      str(timeout) + " s. See " + log_path)
+    elif exit_code != 0:
+        logging.error(script_name + " of " + package_name + " failed with exit code " +
+                      str(exit_code) + ". See " + log_path)
+    else:
+        logging.debug(script_name + " of " + package_name + " finished in %.2f s" % duration)
+    return {"Package": package_name, "Action": action, "Script": command[-1],
+            "Exit code": exit_code, "Duration": duration, "Log": log_path}
+
+async def pump_script_output(stream, output, log_file, package_name):
+    """
+    Copies a script's output line by line into the log
+    and to the console, prefixed with the package name
+    """
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # Overlong line, take what has been read so far
+            line = await stream.read(1024 * 1024)
+        if not line:
+            break
+        text = line.decode("utf-8", errors="replace")
+        log_file.write(text)
+        output.write(package_name + ": " + text)
+        output.flush()
+
+def kill_script(process):
+    """
+    Kills a script together with the processes it started
+    """
+    try:
+        if os.name == "posix":
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
 
 def compile_file(file_path):
     """
@@ -424,12 +679,13 @@ def compile_file(file_path):
     logging.info("Attempting to compile " + file_path)
     try:
         # Create temporary folder to store the files into
-        temp_dir = get_temporary_directory(create_directory=False)
+        temp_root = get_temporary_directory()
+        temp_dir = os.path.join(temp_root, "Package")
         output_file = ""
 
         # Read the file
         with open(file_path) as compilation_info_yaml:
-            other_data = yaml.load(compilation_info_yaml)
+            other_data = yaml.safe_load(compilation_info_yaml)
 
         # Extract compilation information
         ignored_list = []
@@ -443,7 +699,7 @@ def compile_file(file_path):
 
         # Copy the necessary files into the folder
         shutil.copytree(os.path.dirname(file_path), temp_dir,
-                        ignore=shutil.ignore_patterns(*ignored_list))
+                        ignore=shutil.ignore_patterns(*ignored_list), copy_function=copy_file)
 
         # Get the output file name
         output_file = os.path.join(os.getcwd(),
@@ -467,25 +723,82 @@ def compile_file(file_path):
             yaml.dump(data, package_file)
 
         # Run additional compilation steps
-        select_additional_tasks(temp_dir, "Compile")
+        compile_result = select_additional_tasks(temp_dir, "Compile",
+                                                 other_data["Package Information"]["Name"])
+        if not script_succeeded(compile_result):
+            logging.error("Compilation failed")
+            move_to_trash(temp_root)
+            return
 
         # Zip the folder
         compress_folder(temp_dir, output_file)
         logging.info("Compiled package: " + output_file)
 
         # Finish and clean up
-        shutil.rmtree(temp_dir)
+        move_to_trash(temp_root)
     except FileNotFoundError as err:
         logging.critical("File doesn't exist " + str(err))
     except yaml.YAMLError:
         logging.critical("Error decoding YAML")
 
-def decompress_file(file_path, extract_path):
+def extract_to_temporary_directory(file_path):
+    """
+    Decompresses a .star file to a new temporary
+    directory and returns the directory
     """
-    Decompresses a .star file to the path specified
+    temp_dir = get_temporary_directory()
+    logging.debug("Extracting file to temporary directory " + temp_dir)
+    decompress_file(file_path, temp_dir)
+    return temp_dir
+
+def decompress_file(file_path, extract_path):
     """
-    with zipfile.ZipFile(file_path, "r") as z:
-        z.extractall(extract_path)
+    Decompresses a .star file to the path specified. Stored
+    (uncompressed) members are checked in a memory map of the
+    archive and copied straight from it by the kernel.
+    """
+    with open(file_path, "rb") as archive_file:
+        if os.fstat(archive_file.fileno()).st_size == 0:
+            raise zipfile.BadZipFile("File is empty")
+        with mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ) as archive_map:
+            with zipfile.ZipFile(archive_file, "r") as z:
+                for member in z.infolist():
+                    if not extract_stored_member(member, archive_map, archive_file.fileno(),
+                                                 extract_path):
+                        z.extract(member, extract_path)
+
+def extract_stored_member(member, archive_map, archive_descriptor, extract_path):
+    """
+    Extracts a stored, unencrypted member with a plain
+    relative name without copying it through Python.
+    Returns False if the member has to be extracted
+    by zipfile instead.
+    """
+    name = member.filename
+    if (member.compress_type != zipfile.ZIP_STORED or member.flag_bits & 0x1 or
+            name.endswith("/") or name.startswith("/") or "\\" in name or ":" in name or
+            any(part in ("", ".", "..") for part in name.split("/"))):
+        return False
+
+    # Find the data behind the local file header
+    header = archive_map[member.header_offset:member.header_offset + 30]
+    if len(header) != 30 or header[:4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile("Bad local file header of " + name)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    data_start = member.header_offset + 30 + name_length + extra_length
+    data = memoryview(archive_map)[data_start:data_start + member.file_size]
+    try:
+        if len(data) != member.file_size or zlib.crc32(data) != member.CRC:
+            raise zipfile.BadZipFile("Bad CRC-32 for file " + name)
+    finally:
+        data.release()
+
+    target_path = os.path.join(extract_path, *name.split("/"))
+    if not os.path.isdir(os.path.dirname(target_path)):
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    with open(target_path, "wb") as target_file:
+        copy_file_range(archive_descriptor, target_file.fileno(), member.file_size, data_start)
+    return True
 
 def compress_folder(folder_path, zipfile_path):
     """
@@ -493,28 +806,50 @@ def compress_folder(folder_path, zipfile_path):
     """
     shutil.make_archive(zipfile_path, "zip", folder_path)
 
-    # If the file already exists, delete it to prevent an error
-    if os.path.exists(zipfile_path):
-        os.remove(zipfile_path)
-
-    # Remove the .zip part of the file name
-    os.rename(zipfile_path + ".zip", zipfile_path)
+    # Remove the .zip part of the file name, replacing an existing file
+    os.replace(zipfile_path + ".zip", zipfile_path)
 
-def cache_retrieve_file(url, file_name, version):
+def cache_retrieve_file(url, file_name, version, mirrors=None, expected_hash=None,
+                        fallbacks=None):
     """
     Checks the cache if the file is already downloaded. If
-    not, then download the file and add it to the cache.
+    not, or if the cached file doesn't have the expected hash,
+    then download the file and add it to the cache.
     Returns the file path of the local file.
     """
+    local_file_path = cache_get_file_path(file_name, version)
+
     # Check if the file is already in the cache
-    local_file_path = os.path.join(PACKAGE_CACHE_DIRECTORY, file_name, version, file_name)
-    if os.path.isfile(local_file_path):
+    if cache_is_file_cached(file_name, version, expected_hash):
         return local_file_path
 
-    # Download the file into the cache
-    download_file(url, os.path.join(PACKAGE_CACHE_DIRECTORY, file_name, version), file_name)
+    # Download the file into the cache, unless another
+    # process did so while we were waiting for the lock
+    with file_lock(local_file_path + ".lock"):
+        if not cache_is_file_cached(file_name, version, expected_hash):
+            download_file(url, os.path.dirname(local_file_path), file_name,
+                          mirrors=mirrors, expected_hash=expected_hash, fallbacks=fallbacks)
+            if expected_hash is not None:
+                # download_file has checked it, no need to read the file again
+                remember_file_hash(local_file_path, str(expected_hash).lower())
     return local_file_path
 
+def cache_get_file_path(file_name, version):
+    """
+    Returns where the file is stored in the cache
+    """
+    return os.path.join(PACKAGE_CACHE_DIRECTORY, file_name, version, file_name)
+
+def cache_is_file_cached(file_name, version, expected_hash=None):
+    """
+    Returns whether the file is in the cache
+    (with the expected hash, if given)
+    """
+    local_file_path = cache_get_file_path(file_name, version)
+    return os.path.isfile(local_file_path) and (
+        expected_hash is None or
+        get_cached_file_hash(local_file_path) == str(expected_hash).lower())
+
 def cache_clear_old_versions():
     """
     Clears all old versions of programs in the cache
@@ -529,10 +864,611 @@ def cache_clear():
         os.makedirs(PACKAGE_CACHE_DIRECTORY)
         logging.info("Cache is already empty")
         return
-    shutil.rmtree(PACKAGE_CACHE_DIRECTORY)
+    move_to_trash(PACKAGE_CACHE_DIRECTORY)
     os.makedirs(PACKAGE_CACHE_DIRECTORY)
+    move_to_trash(EXTRACTION_CACHE_DIRECTORY)
+    move_to_trash(FILE_HASHES_DIRECTORY)
     logging.info("Cache cleared")
 
+def lock_file(lock_path, shared=False, blocking=True):
+    """
+    Opens and locks the lock file at lock_path. Returns
+    the opened lock file, or None if blocking is False and
+    the lock is held by another process.
+    """
+    if not os.path.exists(os.path.dirname(lock_path)):
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    lock = open(lock_path, "a+")
+    try:
+        if fcntl is not None:
+            operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                operation |= fcntl.LOCK_NB
+            fcntl.flock(lock.fileno(), operation)
+        elif msvcrt is not None and shared:
+            lock_file_shared_on_windows(lock, blocking)
+        elif msvcrt is not None:
+            lock.seek(0)
+            # LK_LOCK gives up after 10 seconds, so keep trying
+            while True:
+                try:
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError as err:
+                    if not blocking or err.errno not in (errno.EACCES, errno.EDEADLK):
+                        raise
+                time.sleep(0.1)
+    except OSError:
+        lock.close()
+        if blocking:
+            raise
+        return None
+    return lock
+
+def unlock_file(lock):
+    """
+    Releases a lock returned by lock_file
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        elif msvcrt is not None:
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+    except OSError:
+        pass
+    lock.close()
+
+class WindowsOverlapped(ctypes.Structure):
+    """
+    OVERLAPPED structure of the Windows API
+    """
+    _fields_ = [("Internal", ctypes.c_void_p),
+                ("InternalHigh", ctypes.c_void_p),
+                ("Offset", ctypes.c_uint32),
+                ("OffsetHigh", ctypes.c_uint32),
+                ("hEvent", ctypes.c_void_p)]
+
+def lock_file_shared_on_windows(lock, blocking):
+    """
+    Takes a shared lock on the first byte of the opened lock
+    file with LockFileEx, which msvcrt can't do. Exclusive
+    msvcrt locks of the same byte conflict with it, and
+    msvcrt's unlocking releases it.
+    """
+    flags = 0 if blocking else 0x1 # LOCKFILE_FAIL_IMMEDIATELY
+    handle = msvcrt.get_osfhandle(lock.fileno())
+    if not ctypes.windll.kernel32.LockFileEx(ctypes.c_void_p(handle), flags, 0, 1, 0,
+                                             ctypes.byref(WindowsOverlapped())):
+        raise ctypes.WinError()
+
+@contextlib.contextmanager
+def file_lock(lock_path, shared=False):
+    """
+    Holds a lock on the lock file at lock_path
+    while the with-block runs
+    """
+    lock = lock_file(lock_path, shared=shared)
+    try:
+        yield lock
+    finally:
+        unlock_file(lock)
+
+def package_lock(package_name):
+    """
+    Returns the lock which has to be held while
+    (un-)installing the package
+    """
+    return file_lock(os.path.join(LOCKS_DIRECTORY, package_name + ".lock"))
+
+@contextlib.contextmanager
+def atomic_write(file_path, mode="w"):
+    """
+    Opens a temporary file next to file_path for writing
+    and moves it over file_path once the with-block finishes,
+    so readers either see the old or the complete new file.
+    The new file keeps the permissions of the old one, or
+    gets the usual ones for new files.
+    """
+    folder_path = os.path.dirname(file_path)
+    file_descriptor, temp_path = tempfile.mkstemp(prefix="." + os.path.basename(file_path),
+                                                  suffix=".tmp", dir=folder_path)
+    try:
+        try:
+            file_mode = os.stat(file_path).st_mode & 0o7777
+        except FileNotFoundError:
+            file_mode = 0o666 & ~CURRENT_UMASK
+        # mkstemp creates files only readable by the owner
+        os.chmod(temp_path, file_mode)
+        with os.fdopen(file_descriptor, mode) as temp_file:
+            yield temp_file
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, file_path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def get_staging_directory():
+    """
+    Returns a new, empty directory on the same file
+    system as the installed files
+    """
+    if not os.path.exists(STAGING_DIRECTORY):
+        os.makedirs(STAGING_DIRECTORY, exist_ok=True)
+    return tempfile.mkdtemp(dir=STAGING_DIRECTORY)
+
+def install_directory(source_dir, installation_dir, move=False, ignore=None):
+    """
+    Copies source_dir to installation_dir, or moves it if move is
+    True and both are on the same file system. The copy is staged
+    first and then renamed into place, so installation_dir is
+    never left half-copied. ignore is passed on to shutil.copytree.
+    The caller has to hold the package lock.
+    """
+    staging_root = get_staging_directory()
+    staging_dir = os.path.join(staging_root, os.path.basename(installation_dir))
+    previous_dir = os.path.join(staging_root, "Previous")
+    try:
+        try:
+            if not move:
+                raise OSError("Copy requested")
+            os.rename(source_dir, staging_dir)
+        except OSError:
+            shutil.copytree(source_dir, staging_dir, ignore=ignore, copy_function=copy_file)
+        if not os.path.exists(os.path.dirname(installation_dir)):
+            os.makedirs(os.path.dirname(installation_dir), exist_ok=True)
+        if os.path.exists(installation_dir):
+            os.rename(installation_dir, previous_dir)
+        try:
+            os.rename(staging_dir, installation_dir)
+        except OSError:
+            # Put the previous installation back
+            if os.path.exists(previous_dir):
+                os.rename(previous_dir, installation_dir)
+            raise
+    finally:
+        move_to_trash(staging_root)
+
+def remove_directory(folder_path):
+    """
+    Moves folder_path out of the way in one rename and
+    deletes it in the background
+    """
+    move_to_trash(folder_path)
+
+def get_trash_directories():
+    """
+    Returns the trash directories, one next to the
+    packages and one next to the temporary directories
+    """
+    return [TRASH_DIRECTORY, os.path.join(get_temporary_root(), "Trash")]
+
+def move_to_trash(path):
+    """
+    Moves the file or folder into the trash directory on the
+    same file system and has it deleted in the background.
+    Deletes it right away if it can't be moved.
+    """
+    if not os.path.lexists(path):
+        return
+    for trash_dir in get_trash_directories():
+        try:
+            if not os.path.exists(trash_dir):
+                os.makedirs(trash_dir, exist_ok=True)
+            if os.stat(trash_dir).st_dev != os.lstat(path).st_dev:
+                continue
+            os.rename(path, os.path.join(tempfile.mkdtemp(dir=trash_dir), "Item"))
+        except OSError:
+            continue
+        schedule_emptying_trash()
+        return
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.remove(path)
+
+def trash_is_empty():
+    """
+    Returns whether all trash directories are empty
+    """
+    return not any(os.path.isdir(trash_dir) and os.listdir(trash_dir)
+                   for trash_dir in get_trash_directories())
+
+def schedule_emptying_trash():
+    """
+    Starts a detached DotStar process emptying the trash, unless
+    one is already running or about to start. A running one
+    checks the trash again when it's done, and one about to
+    start hasn't looked at the trash yet, so neither misses
+    what was just moved there.
+    """
+    lock = lock_file(os.path.join(LOCKS_DIRECTORY, "Trash.lock"), blocking=False)
+    if lock is None:
+        return
+    unlock_file(lock)
+
+    # The marker is removed by the started process
+    scheduled_path = os.path.join(LOCKS_DIRECTORY, "Trash.scheduled")
+    try:
+        # Processes which didn't start within a minute have failed
+        if time.time() - os.path.getmtime(scheduled_path) > 60:
+            os.remove(scheduled_path)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(scheduled_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return
+
+    if getattr(sys, 'frozen', False):
+        command = [sys.executable]
+    else:
+        command = [sys.executable, os.path.realpath(__file__)]
+    command += ["-l", "error", "empty-trash"]
+    options = {"stdin": subprocess.DEVNULL,
+               "stdout": subprocess.DEVNULL,
+               "stderr": subprocess.DEVNULL}
+    if os.name == "posix":
+        options["start_new_session"] = True
+    else:
+        # subprocess.DETACHED_PROCESS only exists since Python 3.7
+        options["creationflags"] = (getattr(subprocess, "DETACHED_PROCESS", 0x00000008) |
+                                    subprocess.CREATE_NEW_PROCESS_GROUP)
+    try:
+        subprocess.Popen(command, **options)
+    except OSError as err:
+        try:
+            os.remove(scheduled_path)
+        except OSError:
+            pass
+        logging.warning("Couldn't start emptying the trash: " + str(err))
+
+def empty_trash():
+    """
+    Deletes everything in the trash directories. Only one
+    process empties the trash at a time.
+    """
+    scheduled_path = os.path.join(LOCKS_DIRECTORY, "Trash.scheduled")
+    if os.path.exists(scheduled_path):
+        try:
+            os.remove(scheduled_path)
+        except FileNotFoundError:
+            pass
+    while True:
+        lock = lock_file(os.path.join(LOCKS_DIRECTORY, "Trash.lock"), blocking=False)
+        if lock is None:
+            return
+        try:
+            while True:
+                entries = [os.path.join(trash_dir, entry)
+                           for trash_dir in get_trash_directories() if os.path.isdir(trash_dir)
+                           for entry in os.listdir(trash_dir)]
+                if not entries:
+                    break
+                for entry in entries:
+                    shutil.rmtree(entry, ignore_errors=True)
+                if any(os.path.exists(entry) for entry in entries):
+                    logging.error("Couldn't empty the trash completely")
+                    return
+        finally:
+            unlock_file(lock)
+
+        # Whatever was moved to the trash while we held the
+        # lock didn't start another process
+        if trash_is_empty():
+            return
+
+def get_file_hash(file_path):
+    """
+    Returns the SHA-256 hex digest of the file
+    """
+    with open(file_path, "rb") as hashed_file:
+        try:
+            with mmap.mmap(hashed_file.fileno(), 0, access=mmap.ACCESS_READ) as hashed_map:
+                return hashlib.sha256(hashed_map).hexdigest()
+        except (ValueError, OverflowError, OSError):
+            # Empty files and files too large for the address space
+            return get_file_object_hash(hashed_file)
+
+def get_cached_file_hash(file_path):
+    """
+    Returns the SHA-256 hex digest of the file like get_file_hash,
+    but remembers it together with the size and modification time
+    of the file, so an unchanged file is only hashed once
+    """
+    file_path = os.path.realpath(file_path)
+    stat = os.stat(file_path)
+    hash_path = get_file_hash_path(file_path)
+    try:
+        with open(hash_path) as hash_json:
+            remembered = json.load(hash_json)
+        if (remembered["Path"] == file_path and remembered["Size"] == stat.st_size and
+                remembered["Modified"] == stat.st_mtime_ns):
+            return remembered["Hash"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    file_hash = get_file_hash(file_path)
+    remember_file_hash(file_path, file_hash, stat)
+    return file_hash
+
+def get_file_hash_path(file_path):
+    """
+    Returns the file remembering the hash of
+    the file at the (real) file_path
+    """
+    return os.path.join(FILE_HASHES_DIRECTORY,
+                        hashlib.sha256(file_path.encode("utf-8")).hexdigest() + ".json")
+
+def remember_file_hash(file_path, file_hash, stat=None):
+    """
+    Remembers the hash of the file for get_cached_file_hash.
+    Files in the temporary directory are not remembered, as
+    their paths aren't used again.
+    """
+    file_path = os.path.realpath(file_path)
+    if file_path.startswith(os.path.join(os.path.realpath(get_temporary_root()), "")):
+        return
+    if stat is None:
+        stat = os.stat(file_path)
+    try:
+        if not os.path.exists(FILE_HASHES_DIRECTORY):
+            os.makedirs(FILE_HASHES_DIRECTORY, exist_ok=True)
+        with atomic_write(get_file_hash_path(file_path), "w") as hash_json:
+            json.dump({"Path": file_path,
+                       "Size": stat.st_size,
+                       "Modified": stat.st_mtime_ns,
+                       "Hash": file_hash}, hash_json)
+    except OSError as err:
+        logging.debug("Couldn't remember the hash of " + file_path + ": " + str(err))
+
+def prune_file_hashes():
+    """
+    Forgets the hashes of files which were
+    changed or removed since
+    """
+    if not os.path.isdir(FILE_HASHES_DIRECTORY):
+        return
+    for file_name in os.listdir(FILE_HASHES_DIRECTORY):
+        hash_path = os.path.join(FILE_HASHES_DIRECTORY, file_name)
+        try:
+            with open(hash_path) as hash_json:
+                remembered = json.load(hash_json)
+            stat = os.stat(remembered["Path"])
+            if (stat.st_size == remembered["Size"] and
+                    stat.st_mtime_ns == remembered["Modified"]):
+                continue
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        try:
+            os.remove(hash_path)
+        except OSError:
+            pass
+
+def copy_file(source_path, destination_path):
+    """
+    Copies the file with its permissions and timestamps like
+    shutil.copy2, but lets the kernel copy the data
+    """
+    with open(source_path, "rb") as source_file, open(destination_path, "wb") as destination_file:
+        copy_file_range(source_file.fileno(), destination_file.fileno(),
+                        os.fstat(source_file.fileno()).st_size)
+    shutil.copystat(source_path, destination_path)
+    return destination_path
+
+def copy_file_range(source_descriptor, destination_descriptor, count, offset=0):
+    """
+    Copies count bytes starting at offset of the source to the
+    current position of the destination. Uses os.copy_file_range
+    (which can share blocks on copy-on-write file systems) or
+    os.sendfile where possible, so the data stays in the kernel.
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < count:
+                length = os.copy_file_range(source_descriptor, destination_descriptor,
+                                            count - copied, offset + copied)
+                if length == 0:
+                    break
+                copied += length
+        except OSError:
+            # E.g. not supported between these file systems
+            pass
+    if copied < count and hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        try:
+            while copied < count:
+                length = os.sendfile(destination_descriptor, source_descriptor,
+                                     offset + copied, count - copied)
+                if length == 0:
+                    break
+                copied += length
+        except OSError:
+            pass
+    while copied < count:
+        os.lseek(source_descriptor, offset + copied, os.SEEK_SET)
+        chunk = os.read(source_descriptor, min(count - copied, 1024 * 1024))
+        if not chunk:
+            raise IOError("Unexpected end of file")
+        os.write(destination_descriptor, chunk)
+        copied += len(chunk)
+
+def get_file_object_hash(file_object):
+    """
+    Returns the SHA-256 hex digest of the rest
+    of the opened file
+    """
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: file_object.read(1024 * 1024), b""):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_directory_listing(folder_path):
+    """
+    Returns the size and modification time of every
+    file in the folder, keyed by relative path
+    """
+    listing = {}
+    for root, _, files in os.walk(folder_path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            stat = os.lstat(file_path)
+            relative_path = os.path.relpath(file_path, folder_path).replace(os.sep, "/")
+            listing[relative_path] = [stat.st_size, stat.st_mtime_ns]
+    return listing
+
+def extraction_cache_verify(entry_dir):
+    """
+    Returns whether all files of the cached extracted tree
+    are unmodified since its extraction. Files created
+    afterwards, e.g. by Run scripts, are ignored.
+    """
+    try:
+        with open(entry_dir + ".json") as manifest_json:
+            manifest = json.load(manifest_json)
+    except (OSError, ValueError):
+        return False
+    if not os.path.isdir(entry_dir):
+        return False
+    for relative_path, (size, modification_time) in manifest["Files"].items():
+        try:
+            stat = os.lstat(os.path.join(entry_dir, *relative_path.split("/")))
+        except OSError:
+            return False
+        if stat.st_size != size or stat.st_mtime_ns != modification_time:
+            return False
+    return True
+
+def extraction_cache_checkout(file_path):
+    """
+    Returns a directory with the extracted contents of the
+    .star file and a lock to hand back to extraction_cache_checkin.
+    Extracted trees are kept between runs, keyed by the hash
+    of the archive, which is only computed again when the
+    archive changes. While checked out, a tree is protected
+    from eviction by a shared lock.
+    """
+    cache_settings = settings.get("Extraction cache", DEFAULT_SETTINGS["Extraction cache"])
+    if not cache_settings["Enabled"]:
+        return extract_to_temporary_directory(file_path), None
+
+    entry_dir = os.path.join(EXTRACTION_CACHE_DIRECTORY, get_cached_file_hash(file_path))
+    lock = lock_file(entry_dir + ".lock", shared=True)
+    if extraction_cache_verify(entry_dir):
+        logging.debug("Using cached extraction " + entry_dir)
+        os.utime(entry_dir + ".json")
+        return entry_dir, lock
+    unlock_file(lock)
+
+    # (Re-)extract the file unless another process is using the stale tree
+    lock = lock_file(entry_dir + ".lock", blocking=False)
+    if lock is None:
+        return extract_to_temporary_directory(file_path), None
+    try:
+        if not extraction_cache_verify(entry_dir):
+            logging.debug("Extracting file to extraction cache " + entry_dir)
+            extraction_cache_remove(entry_dir)
+            staging_dir = tempfile.mkdtemp(prefix=".", dir=EXTRACTION_CACHE_DIRECTORY)
+            try:
+                decompress_file(file_path, staging_dir)
+                os.rename(staging_dir, entry_dir)
+            except:
+                move_to_trash(staging_dir)
+                raise
+            files = get_directory_listing(entry_dir)
+            directories = [os.path.relpath(root, entry_dir).replace(os.sep, "/")
+                           for root, _, _ in os.walk(entry_dir) if root != entry_dir]
+            with atomic_write(entry_dir + ".json", "w") as manifest_json:
+                json.dump({"Size": sum(size for size, _ in files.values()),
+                           "Files": files,
+                           "Directories": directories}, manifest_json)
+    finally:
+        unlock_file(lock)
+    extraction_cache_evict(cache_settings["Maximum size in MB"] * 1024 * 1024,
+                           keep=entry_dir)
+    prune_file_hashes()
+
+    lock = lock_file(entry_dir + ".lock", shared=True)
+    if extraction_cache_verify(entry_dir):
+        return entry_dir, lock
+    unlock_file(lock)
+    return extract_to_temporary_directory(file_path), None
+
+def extraction_cache_checkin(directory, lock):
+    """
+    Hands back a directory returned by extraction_cache_checkout
+    """
+    if lock is None:
+        move_to_trash(directory)
+        logging.debug("Removed temporary directory " + directory)
+    else:
+        unlock_file(lock)
+
+def extraction_cache_ignore_added_files(entry_dir):
+    """
+    Returns a shutil.copytree ignore function skipping
+    the files and folders created in the cached extracted
+    tree after its extraction
+    """
+    with open(entry_dir + ".json") as manifest_json:
+        manifest = json.load(manifest_json)
+    extracted = set(manifest.get("Directories", []))
+    for relative_path in manifest["Files"]:
+        parts = relative_path.split("/")
+        for index in range(1, len(parts) + 1):
+            extracted.add("/".join(parts[:index]))
+
+    def ignore(folder_path, names):
+        relative_folder = os.path.relpath(folder_path, entry_dir).replace(os.sep, "/")
+        prefix = "" if relative_folder == "." else relative_folder + "/"
+        return [name for name in names if prefix + name not in extracted]
+    return ignore
+
+def extraction_cache_remove(entry_dir):
+    """
+    Removes an extracted tree from the extraction cache.
+    The caller has to hold the exclusive lock of the entry.
+    """
+    if os.path.exists(entry_dir + ".json"):
+        os.remove(entry_dir + ".json")
+    move_to_trash(entry_dir)
+
+def extraction_cache_evict(maximum_size, keep=None):
+    """
+    Removes the least recently used extracted trees until the
+    extraction cache is at most maximum_size bytes large.
+    Trees which are currently in use are skipped.
+    """
+    entries = []
+    for file_name in os.listdir(EXTRACTION_CACHE_DIRECTORY):
+        if not file_name.endswith(".json"):
+            continue
+        manifest_path = os.path.join(EXTRACTION_CACHE_DIRECTORY, file_name)
+        try:
+            with open(manifest_path) as manifest_json:
+                size = json.load(manifest_json)["Size"]
+            entries.append((os.path.getmtime(manifest_path), size, manifest_path[:-len(".json")]))
+        except (OSError, ValueError, KeyError):
+            continue
+    total_size = sum(size for _, size, _ in entries)
+
+    for _, size, entry_dir in sorted(entries):
+        if total_size <= maximum_size:
+            break
+        if entry_dir == keep:
+            continue
+        lock = lock_file(entry_dir + ".lock", blocking=False)
+        if lock is None:
+            continue
+        try:
+            extraction_cache_remove(entry_dir)
+            total_size -= size
+            logging.debug("Evicted cached extraction " + entry_dir)
+        finally:
+            unlock_file(lock)
+
 def is_url(path):
     """
     Returns whether path is a URL
@@ -546,23 +1482,241 @@ def is_url(path):
         r'(?:/?|[/?]\S+)$', re.IGNORECASE)
     return bool(regex.match(path))
 
-def download_file(url, folder_path, file_name="Temp.star"):
+def download_file(url, folder_path, file_name="Temp.star", mirrors=None, expected_hash=None,
+                  fallbacks=None):
     """
     Downloads a .star file and returns the file path
-    of the downloaded file
+    of the downloaded file. The mirrors are used when url
+    fails, and large files are downloaded in segments from
+    all of them at once. The fallbacks are only used when
+    url and all mirrors fail. If expected_hash is given, the
+    file is only kept if its SHA-256 hash matches.
     """
     logging.info("Downloading " + url)
     if not is_url(url):
         logging.error("URL is not valid.")
         return
+    urls = [url] + get_valid_urls(mirrors)
+    fallback_urls = get_valid_urls(fallbacks)
     if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
+        os.makedirs(folder_path, exist_ok=True)
     file_path = os.path.join(folder_path, file_name)
-    r = requests.get(url)
-    with open(file_path, "wb") as dotstarfile:
-        dotstarfile.write(r.content)
+
+    with atomic_write(file_path, "w+b") as dotstarfile:
+        try:
+            download_from_urls(urls, dotstarfile, expected_hash)
+        except (requests.RequestException, IOError) as err:
+            if not fallback_urls:
+                raise
+            logging.warning("Download of " + url + " failed (" + str(err) +
+                            "), using the fallback URLs")
+            download_from_urls(fallback_urls, dotstarfile, expected_hash)
     return file_path
 
+def get_valid_urls(urls):
+    """
+    Returns the valid URLs of the list (which may be None)
+    """
+    valid_urls = []
+    for url in urls or []:
+        if is_url(url):
+            valid_urls.append(url)
+        else:
+            logging.warning("Ignoring invalid mirror URL " + str(url))
+    return valid_urls
+
+def download_from_urls(urls, output_file, expected_hash=None):
+    """
+    Downloads the file from the URLs into output_file, large
+    files in segments from all URLs at once, and checks
+    its hash if expected_hash is given
+    """
+    download_settings = settings.get("Downloads", DEFAULT_SETTINGS["Downloads"])
+    threshold = int(download_settings["Segmented download threshold in MB"] * 1024 * 1024)
+    maximum_wait = download_settings.get(
+        "Maximum wait for busy servers in seconds",
+        DEFAULT_SETTINGS["Downloads"]["Maximum wait for busy servers in seconds"])
+    size, range_urls = download_probe(urls, threshold)
+    if range_urls:
+        try:
+            download_segments(range_urls, size, output_file,
+                              int(download_settings["Segment size in MB"] * 1024 * 1024),
+                              download_settings["Connections"], maximum_wait=maximum_wait)
+        except IOError as err:
+            logging.warning("Segmented download of " + urls[0] + " failed (" + str(err) +
+                            "), downloading it in one piece")
+            download_stream(urls, output_file, maximum_wait)
+    else:
+        download_stream(urls, output_file, maximum_wait)
+    if expected_hash is not None:
+        output_file.seek(0)
+        if get_file_object_hash(output_file) != str(expected_hash).lower():
+            raise IOError("Hash of " + urls[0] + " doesn't match the expected hash")
+
+def get_retry_delay(response):
+    """
+    Returns after how many seconds a request answered with
+    503 Service Unavailable and a Retry-After header should
+    be repeated, or None if it shouldn't be repeated
+    """
+    if response.status_code != 503:
+        return None
+    try:
+        return min(max(int(response.headers["Retry-After"]), 1), 60)
+    except (KeyError, ValueError):
+        return None
+
+def download_probe(urls, threshold):
+    """
+    Returns the size of the file and the URLs supporting
+    range requests for it, if the file is at least threshold
+    bytes large. Otherwise returns (None, []).
+    """
+    size = None
+    range_urls = []
+    for url in urls:
+        try:
+            r = requests.head(url, allow_redirects=True, timeout=10)
+            r.raise_for_status()
+            url_size = int(r.headers["Content-Length"])
+        except (requests.RequestException, KeyError, ValueError):
+            continue
+        if size is None:
+            if url_size < threshold:
+                return None, []
+            size = url_size
+        if url_size == size and r.headers.get("Accept-Ranges") == "bytes":
+            range_urls.append(url)
+    return size, range_urls
+
+def download_stream(urls, output_file, maximum_wait=0):
+    """
+    Downloads the file from the first URL that works. A URL
+    which is busy (e.g. a mirror still filling its cache) is
+    asked again for up to maximum_wait seconds.
+    """
+    for url in urls:
+        begin = time.monotonic()
+        try:
+            while True:
+                with requests.get(url, stream=True, timeout=30) as r:
+                    retry_delay = get_retry_delay(r)
+                    if retry_delay is None or time.monotonic() - begin > maximum_wait:
+                        r.raise_for_status()
+                        output_file.seek(0)
+                        output_file.truncate()
+                        for chunk in r.iter_content(1024 * 1024):
+                            output_file.write(chunk)
+                        return
+                logging.debug(url + " is busy, asking again in " + str(retry_delay) + " s")
+                time.sleep(retry_delay)
+        except requests.RequestException as err:
+            logging.warning("Download from " + url + " failed: " + str(err))
+            if url == urls[-1]:
+                raise
+
+def download_segments(urls, size, output_file, segment_size, connections,
+                      maximum_errors=3, maximum_wait=0):
+    """
+    Downloads the file in HTTP range segments over several
+    connections. Every segment goes to the mirror with the best
+    measured throughput per active connection. Failed segments
+    are retried on another mirror, and mirrors failing
+    maximum_errors times are no longer used. Mirrors which
+    haven't delivered a segment yet or have failed only get as
+    many requests at a time as they may still fail. Busy mirrors
+    are asked again for up to maximum_wait seconds.
+    """
+    segments = queue.Queue()
+    for start in range(0, size, segment_size):
+        segments.put((start, min(start + segment_size, size) - 1))
+    stats = {url: {"Bytes": 0, "Seconds": 0.0, "Active": 0, "Errors": 0, "Busy since": None}
+             for url in urls}
+    stats_lock = threading.Condition()
+    write_lock = threading.Lock()
+    output_file.truncate(size)
+
+    def is_available(url):
+        if stats[url]["Errors"] == 0 and stats[url]["Bytes"] > 0:
+            return True
+        return stats[url]["Active"] < maximum_errors - stats[url]["Errors"]
+
+    def pick_mirror():
+        with stats_lock:
+            while True:
+                if all(stats[url]["Errors"] >= maximum_errors for url in urls):
+                    return None
+                candidates = [url for url in urls if is_available(url)]
+                if candidates:
+                    break
+                stats_lock.wait()
+
+            def score(url):
+                throughput = float("inf")
+                if stats[url]["Seconds"] > 0:
+                    throughput = stats[url]["Bytes"] / stats[url]["Seconds"]
+                return (-throughput / (1 + stats[url]["Active"]), stats[url]["Active"])
+
+            url = min(candidates, key=score)
+            stats[url]["Active"] += 1
+            return url
+
+    def worker():
+        session = requests.Session()
+        while True:
+            try:
+                start, end = segments.get_nowait()
+            except queue.Empty:
+                return
+            url = pick_mirror()
+            if url is None:
+                raise IOError("All mirrors failed")
+            begin = time.monotonic()
+            try:
+                r = session.get(url, headers={"Range": "bytes=%d-%d" % (start, end)}, timeout=30)
+                retry_delay = get_retry_delay(r)
+                if retry_delay is not None:
+                    with stats_lock:
+                        if stats[url]["Busy since"] is None:
+                            stats[url]["Busy since"] = begin
+                        is_waiting = time.monotonic() - stats[url]["Busy since"] <= maximum_wait
+                        if is_waiting:
+                            stats[url]["Active"] -= 1
+                            stats_lock.notify_all()
+                    if is_waiting:
+                        segments.put((start, end))
+                        time.sleep(retry_delay)
+                        continue
+                if r.status_code != 206 or len(r.content) != end - start + 1:
+                    raise IOError("invalid response to range request (HTTP " +
+                                  str(r.status_code) + ")")
+            except (requests.RequestException, IOError) as err:
+                logging.warning("Segment download from " + url + " failed: " + str(err))
+                with stats_lock:
+                    stats[url]["Active"] -= 1
+                    stats[url]["Errors"] += 1
+                    stats_lock.notify_all()
+                segments.put((start, end))
+                continue
+            with stats_lock:
+                stats[url]["Active"] -= 1
+                stats[url]["Bytes"] += len(r.content)
+                stats[url]["Seconds"] += time.monotonic() - begin
+                stats_lock.notify_all()
+            with write_lock:
+                output_file.seek(start)
+                output_file.write(r.content)
+
+    worker_count = max(1, min(connections, segments.qsize()))
+    with concurrent.futures.ThreadPoolExecutor(worker_count) as executor:
+        workers = [executor.submit(worker) for _ in range(worker_count)]
+        for future in workers:
+            future.result()
+    for url in urls:
+        if stats[url]["Seconds"] > 0:
+            logging.debug("Mirror " + url + ": %.1f MB/s" %
+                          (stats[url]["Bytes"] / stats[url]["Seconds"] / 1024 / 1024))
+
 def verify_integrity(folder_path, integrity_info):
     """
     Verifies the folder's integrity using the data
@@ -578,11 +1732,19 @@ def refresh_local_repo():
     if not os.path.exists(REPO_DIRECTORY):
         os.makedirs(REPO_DIRECTORY)
     repo_id = 0
+    failures = 0
     for repository in settings["Repositories"]:
         # Download file
-        download_file(repository, REPO_DIRECTORY, file_name="Repo" + str(repo_id) + ".star")
+        try:
+            download_file(repository, REPO_DIRECTORY, file_name="Repo" + str(repo_id) + ".star")
+        except (requests.RequestException, IOError) as err:
+            logging.error("Couldn't refresh repository " + repository + ": " + str(err))
+            failures += 1
         repo_id += 1
-    logging.info("Repositories refreshed successfully")
+    if failures == 0:
+        logging.info("Repositories refreshed successfully")
+    else:
+        logging.warning(str(failures) + " of " + str(repo_id) + " repositories couldn't be refreshed")
 
 def clear_local_repo():
     """
@@ -592,7 +1754,7 @@ def clear_local_repo():
         os.makedirs(REPO_DIRECTORY)
         logging.info("Local repository is already empty")
         return
-    shutil.rmtree(REPO_DIRECTORY)
+    move_to_trash(REPO_DIRECTORY)
     os.makedirs(REPO_DIRECTORY)
     logging.info("Local repository cleared")
 
@@ -641,10 +1803,12 @@ def list_all_repo_files():
     if not os.path.exists(REPO_DIRECTORY):
         return []
     # Get all files in the repository directory
-    onlyfiles = [f for f in os.listdir(REPO_DIRECTORY) if os.path.isfile(os.path.join(REPO_DIRECTORY, f))]
+    # (Hidden files are repositories which are still being downloaded)
+    onlyfiles = [f for f in os.listdir(REPO_DIRECTORY)
+                 if os.path.isfile(os.path.join(REPO_DIRECTORY, f)) and not f.startswith(".")]
     for filename in onlyfiles:
         with open(os.path.join(REPO_DIRECTORY, filename)) as repo_yaml:
-            all_repo_files += yaml.load(repo_yaml)["Packages"]
+            all_repo_files += yaml.safe_load(repo_yaml)["Packages"]
     return all_repo_files
 
 def list_installed_files():
@@ -721,21 +1885,453 @@ def search_installed_files(file_name):
     all_installed_files = list_installed_files()
     return list(filter(lambda item: item == file_name, all_installed_files))
 
-def get_temporary_directory(in_folder_path=os.path.join(tempfile.gettempdir(),
-                                                        "DotStar"),
-                            create_directory=True):
+def get_installed_version(file_name):
     """
-    Returns a temporary directory path that is guaranteed to not
-    yet exist
+    Returns the version of the installed file (without
+    ".star") or None if it isn't installed
     """
-    directory = os.path.join(in_folder_path,
-                             str(random.randint(0, 10000)))
-    while os.path.exists(directory):
-        directory = os.path.join(in_folder_path,
-                                 str(random.randint(0, 10000)))
-    if create_directory:
-        os.makedirs(directory)
-    return directory
+    package_info_file = os.path.join(INSTALLED_FILES_DIRECTORY, file_name, PACKAGE_INFO_FILE)
+    try:
+        with open(package_info_file) as package_info_yaml:
+            data = yaml.safe_load(package_info_yaml)
+        return str(data["Package Information"]["Version"])
+    except (OSError, yaml.YAMLError, KeyError, TypeError):
+        return None
+
+def get_installed_hash(file_name):
+    """
+    Returns the SHA-256 hash of the .star file the installed
+    file (without ".star") was installed from, or None if
+    it isn't known
+    """
+    hash_path = os.path.join(INSTALLED_FILES_DIRECTORY, file_name, PACKAGE_HASH_FILE)
+    try:
+        with open(hash_path) as hash_file:
+            return hash_file.read().strip()
+    except OSError:
+        return None
+
+def set_installed_hash(file_name, file_hash):
+    """
+    Remembers the SHA-256 hash of the .star file the installed
+    file (without ".star") was installed from, or forgets
+    it if file_hash is None
+    """
+    hash_path = os.path.join(INSTALLED_FILES_DIRECTORY, file_name, PACKAGE_HASH_FILE)
+    if file_hash is None:
+        if os.path.exists(hash_path):
+            os.remove(hash_path)
+    else:
+        with atomic_write(hash_path, "w") as hash_file:
+            hash_file.write(file_hash)
+
+def load_lockfile(lockfile_path):
+    """
+    Returns the packages pinned in the lockfile. Every package
+    needs a Name and a Version and may have a Hash (SHA-256 of
+    the .star file) and a URL.
+    """
+    with open(lockfile_path) as lockfile_yaml:
+        data = yaml.safe_load(lockfile_yaml)
+    packages = []
+    for package in data.get("Packages") or []:
+        package = dict(package)
+        package["Version"] = str(package["Version"])
+        if "Hash" in package:
+            package["Hash"] = str(package["Hash"]).lower()
+        packages.append(package)
+    return packages
+
+def sync_plan(pinned_packages):
+    """
+    Compares the pinned packages with the installed ones
+    and returns the packages to install, the packages to
+    remove and the number of unchanged packages
+    """
+    to_install = []
+    unchanged = 0
+    pinned_names = set()
+    for package in pinned_packages:
+        pinned_names.add(package["Name"])
+        if sync_is_installed(package):
+            unchanged += 1
+        else:
+            to_install.append(package)
+    to_remove = [name for name in list_installed_files() if name not in pinned_names]
+    return to_install, to_remove, unchanged
+
+def sync_is_installed(package):
+    """
+    Returns whether the pinned package is installed in the
+    pinned version and, if it is pinned, from the pinned .star file
+    """
+    if get_installed_version(package["Name"]) != package["Version"]:
+        return False
+    return "Hash" not in package or get_installed_hash(package["Name"]) == package["Hash"]
+
+def sync_install_package(package, repo_files):
+    """
+    Downloads, verifies and installs a pinned package.
+    Returns whether the package is installed afterwards.
+    """
+    name = package["Name"]
+    if is_locked(name):
+        logging.error(name + " is locked. To manipulate this file, unlock it first.")
+        return False
+    source = package
+    if "URL" not in package:
+        matches = [item for item in repo_files
+                   if item["Name"] == name and str(item["Version"]) == package["Version"]]
+        if len(matches) < 1:
+            logging.error("No package " + name + " " + package["Version"] +
+                          " found in the repositories")
+            return False
+        source = matches[0]
+
+    try:
+        local_file_path = cache_retrieve_file(source["URL"], name, package["Version"],
+                                              source.get("Mirrors"),
+                                              package.get("Hash", source.get("Hash")),
+                                              source.get("Fallbacks"))
+    except (OSError, requests.RequestException) as err:
+        logging.error("Couldn't download " + name + ": " + str(err))
+        return False
+    if local_file_path is None or not os.path.isfile(local_file_path):
+        logging.error("Couldn't download " + name)
+        return False
+
+    if not open_local_file_or_folder(local_file_path, action="Install"):
+        return False
+    return sync_is_installed(package)
+
+def sync_remove_package(name):
+    """
+    Uninstalls a package which is not in the lockfile.
+    Returns whether the package is removed afterwards.
+    """
+    if is_locked(name):
+        logging.error(name + " is locked. To manipulate this file, unlock it first.")
+        return False
+    if not open_local_file_or_folder(os.path.join(INSTALLED_FILES_DIRECTORY, name),
+                                     action="Uninstall"):
+        return False
+    return not is_installed(name)
+
+def sync_lockfile(lockfile_path):
+    """
+    Brings the installed files in line with the lockfile by
+    installing, upgrading and removing only the packages
+    which differ. Packages are processed in parallel.
+    Returns whether all changes succeeded.
+    """
+    try:
+        pinned_packages = load_lockfile(lockfile_path)
+    except (OSError, yaml.YAMLError, KeyError, TypeError, AttributeError) as err:
+        logging.critical("Couldn't read lockfile " + str(lockfile_path) + ": " + str(err))
+        return False
+
+    to_install, to_remove, unchanged = sync_plan(pinned_packages)
+    if not to_install and not to_remove:
+        logging.info("Everything is up-to-date (" + str(unchanged) + " packages)")
+        return True
+
+    repo_files = []
+    if any("URL" not in package for package in to_install):
+        repo_files = list_all_repo_files()
+    sync_settings = settings.get("Sync", DEFAULT_SETTINGS["Sync"])
+    results = run_in_worker_threads(
+        [(sync_install_package, (package, repo_files)) for package in to_install] +
+        [(sync_remove_package, (name,)) for name in to_remove],
+        sync_settings["Parallel jobs"])
+    installed = sum(1 for result in results[:len(to_install)] if result)
+    removed = sum(1 for result in results[len(to_install):] if result)
+
+    logging.info("Sync finished: " + str(installed) + " installed or upgraded, " +
+                 str(removed) + " removed, " + str(unchanged) + " unchanged, " +
+                 str(len(to_install) + len(to_remove) - installed - removed) + " failed")
+    return installed == len(to_install) and removed == len(to_remove)
+
+def mirror_rewrite_catalog(packages, base_url):
+    """
+    Returns a repository whose package URLs point at
+    the mirror reachable under base_url. The upstream URLs
+    are kept as fallbacks, which clients only use when
+    the mirror fails.
+    """
+    rewritten_packages = []
+    for package in packages:
+        rewritten_package = dict(package)
+        rewritten_package["URL"] = (base_url + "/Packages/" +
+                                    urllib.parse.quote(package["Name"], safe="") + "/" +
+                                    urllib.parse.quote(str(package["Version"]), safe=""))
+        rewritten_package["Fallbacks"] = ([package["URL"]] + list(package.get("Mirrors") or []) +
+                                          list(package.get("Fallbacks") or []))
+        rewritten_package.pop("Mirrors", None)
+        rewritten_packages.append(rewritten_package)
+    return {"Packages": rewritten_packages}
+
+def mirror_coalesced_call(key, function):
+    """
+    Starts calling function in the background, unless a call
+    with the same key is already running, and returns the
+    future of the running call
+    """
+    with mirror_fetches_lock:
+        future = mirror_fetches_in_flight.get(key)
+        if future is not None:
+            return future
+        future = concurrent.futures.Future()
+        mirror_fetches_in_flight[key] = future
+
+    def call():
+        try:
+            future.set_result(function())
+        except Exception as err:
+            future.set_exception(err)
+        finally:
+            with mirror_fetches_lock:
+                del mirror_fetches_in_flight[key]
+
+    threading.Thread(target=call, daemon=True).start()
+    return future
+
+def mirror_retrieve_package(package):
+    """
+    Returns a future of the cached file of the package,
+    downloading it from upstream first if necessary.
+    Concurrent requests for the same package only
+    trigger one download.
+    """
+    name = package["Name"]
+    version = str(package["Version"])
+    local_file_path = cache_get_file_path(name, version)
+    if (cache_is_file_cached(name, version, package.get("Hash")) and
+            zipfile.is_zipfile(local_file_path)):
+        future = concurrent.futures.Future()
+        future.set_result(local_file_path)
+        return future
+
+    def fetch():
+        try:
+            cache_retrieve_file(package["URL"], name, version, package.get("Mirrors"),
+                                package.get("Hash"), package.get("Fallbacks"))
+            if not zipfile.is_zipfile(local_file_path):
+                # Don't keep upstream error pages in the cache
+                if os.path.isfile(local_file_path):
+                    os.remove(local_file_path)
+                raise IOError("Upstream returned no valid package for " + name + " " + version)
+        except (IOError, requests.RequestException) as err:
+            logging.error("Mirror couldn't retrieve " + name + ": " + str(err))
+            raise
+        return local_file_path
+
+    return mirror_coalesced_call((name, version), fetch)
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the local repositories and the package cache
+    to other DotStar hosts
+    """
+    def do_GET(self):
+        """
+        Handles GET requests
+        """
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        parts = [part for part in path.split("/") if part]
+        if any(part in (".", "..") or "\\" in part for part in parts):
+            self.send_error(404)
+        elif parts in ([], ["Master.yml"]):
+            self.send_repository(list_all_repo_files())
+        elif len(parts) == 2 and parts[0] == "Repositories":
+            self.send_repository_file(parts[1])
+        elif len(parts) == 3 and parts[0] == "Packages":
+            self.send_package(parts[1], parts[2])
+        else:
+            self.send_error(404)
+
+    def do_HEAD(self):
+        """
+        Handles HEAD requests like GET requests,
+        without sending the body
+        """
+        self.do_GET()
+
+    def get_base_url(self):
+        """
+        Returns the URL under which the client reached us
+        """
+        host = self.headers.get("Host")
+        if host is None:
+            host = "%s:%d" % self.server.server_address[:2]
+        return "http://" + host
+
+    def send_repository(self, packages):
+        """
+        Sends a repository with rewritten package URLs
+        """
+        catalog = mirror_rewrite_catalog(packages, self.get_base_url())
+        content = yaml.dump(catalog).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/yaml")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def send_repository_file(self, file_name):
+        """
+        Sends a single local repository file
+        """
+        if not os.path.exists(REPO_DIRECTORY) or file_name not in os.listdir(REPO_DIRECTORY):
+            self.send_error(404)
+            return
+        try:
+            with open(os.path.join(REPO_DIRECTORY, file_name)) as repo_yaml:
+                packages = yaml.safe_load(repo_yaml)["Packages"]
+        except yaml.YAMLError:
+            self.send_error(500, "Error decoding YAML")
+            return
+        self.send_repository(packages)
+
+    def send_package(self, name, version):
+        """
+        Sends a package from the cache, filling
+        misses from upstream
+        """
+        matches = [package for package in list_all_repo_files()
+                   if package["Name"] == name and str(package["Version"]) == version]
+        if len(matches) < 1:
+            self.send_error(404)
+            return
+        future = mirror_retrieve_package(matches[0])
+        if (self.command == "HEAD" and not future.done() and
+                self.send_upstream_headers(matches[0])):
+            return
+        mirror_settings = settings.get("Mirror", DEFAULT_SETTINGS["Mirror"])
+        wait = mirror_settings.get("Wait for upstream in seconds",
+                                   DEFAULT_SETTINGS["Mirror"]["Wait for upstream in seconds"])
+        try:
+            local_file_path = future.result(timeout=wait)
+        except concurrent.futures.TimeoutError:
+            # Don't hold the request until the download is done,
+            # clients would run into their read timeout
+            self.send_response(503)
+            self.send_header("Retry-After", str(max(1, int(wait))))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        except (IOError, requests.RequestException):
+            self.send_error(502)
+            return
+        with open(local_file_path, "rb") as package_file:
+            size = os.fstat(package_file.fileno()).st_size
+            start, end = 0, size - 1
+            byte_range = re.match(r"^bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+            if byte_range and (byte_range.group(1) or byte_range.group(2)):
+                if not byte_range.group(1):
+                    start = max(0, size - int(byte_range.group(2)))
+                else:
+                    start = int(byte_range.group(1))
+                    if byte_range.group(2):
+                        end = min(end, int(byte_range.group(2)))
+                if start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */" + str(size))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            if self.command != "HEAD" and end >= start:
+                # Let the kernel send the file straight from the page cache
+                self.connection.sendfile(package_file, start, end - start + 1)
+
+    def send_upstream_headers(self, package):
+        """
+        Answers a HEAD request for a package which isn't cached
+        yet with the size reported upstream, so the client doesn't
+        wait for the whole download. Returns False if no
+        upstream URL answered.
+        """
+        for url in ([package["URL"]] + list(package.get("Mirrors") or []) +
+                    list(package.get("Fallbacks") or [])):
+            try:
+                r = requests.head(url, allow_redirects=True, timeout=5)
+                r.raise_for_status()
+                size = int(r.headers["Content-Length"])
+            except (requests.RequestException, KeyError, ValueError):
+                continue
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            return True
+        return False
+
+    def log_message(self, format, *args):
+        logging.debug("Mirror: " + (format % args))
+
+class MirrorServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each mirror request in its own thread
+    """
+    daemon_threads = True
+
+def create_mirror_server(address=None, port=None):
+    """
+    Creates the mirror server, using the mirror settings
+    for every unspecified argument
+    """
+    mirror_settings = settings.get("Mirror", DEFAULT_SETTINGS["Mirror"])
+    if address is None:
+        address = mirror_settings["Address"]
+    if port is None:
+        port = mirror_settings["Port"]
+    return MirrorServer((address, int(port)), MirrorRequestHandler)
+
+def serve_mirror():
+    """
+    Serves the local repositories and package cache over
+    HTTP until interrupted. Other hosts can add
+    http://<host>:<port>/Master.yml as repository.
+    """
+    server = create_mirror_server()
+    logging.info("Serving mirror on %s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    logging.info("Mirror stopped")
+
+def get_temporary_root():
+    """
+    Returns the folder holding DotStar's temporary
+    directories. Can be moved to a faster file system
+    with the "Temporary directory" setting.
+    """
+    if settings is not None and settings.get("Temporary directory"):
+        return settings["Temporary directory"]
+    return os.path.join(tempfile.gettempdir(), "DotStar")
+
+def get_temporary_directory(in_folder_path=None):
+    """
+    Creates a new, empty temporary directory and
+    returns its path
+    """
+    if in_folder_path is None:
+        in_folder_path = get_temporary_root()
+    if not os.path.exists(in_folder_path):
+        os.makedirs(in_folder_path, exist_ok=True)
+    return tempfile.mkdtemp(dir=in_folder_path)
 
 if __name__ == "__main__":
     # Main code goes here
@@ -785,13 +2381,28 @@ if __name__ == "__main__":
     # Yes to all ?
     yes_to_all = bool(settings["Security"]["Always allow running scripts"] or result.yestoall)
 
+    # Finish deleting what previous runs left in the trash
+    if "empty-trash" not in result.files and not trash_is_empty():
+        schedule_emptying_trash()
+
     # Go though input files
-    for input_file in result.files:
+    input_files = iter(result.files)
+    for input_file in input_files:
         # Commands
         if input_file == "refresh":
             refresh_local_repo()
         elif input_file == "clear":
             clear_local_repo()
+        elif input_file == "empty-trash":
+            empty_trash()
+        elif input_file == "serve-mirror":
+            serve_mirror()
+        elif input_file == "sync":
+            lockfile = next(input_files, None)
+            if lockfile is None:
+                logging.error("No lockfile specified")
+            elif not sync_lockfile(lockfile):
+                sys.exit(1)
         elif input_file == "listall":
             all_available_files = list_all_repo_files()
             if len(all_available_files) < 1:
@@ -824,17 +2435,17 @@ if __name__ == "__main__":
             for item in search_repos_for_files(input_file):
                 print(item)
         elif result.lock:
-            lock_installed_file(input_file)
-            save_settings()
+            with settings_transaction():
+                lock_installed_file(input_file)
         elif result.unlock:
-            unlock_locked_file(input_file)
-            save_settings()
+            with settings_transaction():
+                unlock_locked_file(input_file)
         elif result.add_repo:
-            add_repo(input_file)
-            save_settings()
+            with settings_transaction():
+                add_repo(input_file)
         elif result.remove_repo:
-            remove_repo(input_file)
-            save_settings()
+            with settings_transaction():
+                remove_repo(input_file)
         else:
             # Normal file
             action_to_perform = '0'
@@ -0,0 +1,178 @@
+"""
+Benchmark for DotStar's file handling: hashing, extracting
+and installing a large generated package, each next to
+the plain Python way DotStar used to do it
+"""
+
+# IMPORTS
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import zipfile
+import argparse
+import inspect
+import importlib.util
+
+# CONSTANTS
+DOTSTAR_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                              "DotStar", "DotStar.py")
+
+def load_dotstar(script_path):
+    """
+    Imports DotStar.py from script_path as a module
+    """
+    spec = importlib.util.spec_from_file_location("DotStar", script_path)
+    dotstar = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(dotstar)
+    dotstar.load_settings(os.path.join(tempfile.gettempdir(), "DotStarBenchmarkSettings.yml"))
+    return dotstar
+
+def generate_package(folder_path, large_file_size, small_file_count):
+    """
+    Creates a package folder with one large file and many small
+    files, and a stored (uncompressed) .star file of it
+    """
+    package_dir = os.path.join(folder_path, "Package")
+    os.makedirs(os.path.join(package_dir, "Small"))
+    with open(os.path.join(package_dir, "Package.yml"), "w") as package_yaml:
+        package_yaml.write("Package Information: {Name: benchmark, Version: 1.0.0}\n")
+    with open(os.path.join(package_dir, "Large.bin"), "wb") as large_file:
+        for _ in range(large_file_size // (1024 * 1024)):
+            large_file.write(os.urandom(1024 * 1024))
+    for index in range(small_file_count):
+        with open(os.path.join(package_dir, "Small", str(index)), "wb") as small_file:
+            small_file.write(os.urandom(4096))
+
+    archive_path = os.path.join(folder_path, "benchmark.star")
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_STORED) as z:
+        for root, _, files in os.walk(package_dir):
+            for name in files:
+                file_path = os.path.join(root, name)
+                z.write(file_path, os.path.relpath(file_path, package_dir))
+    return package_dir, archive_path
+
+def measure(function, repeat, setup=None):
+    """
+    Runs function repeat times (each time after setup) and
+    returns the wall-clock, user CPU and system CPU time
+    in seconds of the fastest run
+    """
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        before_times, before_wall = os.times(), time.perf_counter()
+        function()
+        after_times, after_wall = os.times(), time.perf_counter()
+        run = (after_wall - before_wall,
+               after_times.user - before_times.user,
+               after_times.system - before_times.system)
+        if best is None or run[0] < best[0]:
+            best = run
+    return best
+
+def baseline_hash(file_path):
+    """
+    Hashes the file the way DotStar used to,
+    reading it through hashlib in 1 MB chunks
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def baseline_extract(archive_path, extract_path):
+    """
+    Extracts the archive the way DotStar used to
+    """
+    with zipfile.ZipFile(archive_path, "r") as z:
+        z.extractall(extract_path)
+
+def is_supported(dotstar, function_name, parameter=None):
+    """
+    Returns whether this DotStar version has the function
+    (and the function has the parameter)
+    """
+    function = getattr(dotstar, function_name, None)
+    if function is None:
+        return False
+    return parameter is None or parameter in inspect.signature(function).parameters
+
+def run_benchmarks(dotstar, work_dir, archive_path, repeat):
+    """
+    Runs all benchmarks and returns a list of (name, wall
+    time, user CPU time, system CPU time), the times being
+    None for benchmarks this DotStar version doesn't support
+    """
+    extract_dir = os.path.join(work_dir, "Extracted")
+    baseline_dir = os.path.join(work_dir, "Baseline")
+    installation_dir = os.path.join(work_dir, "Installed", "benchmark")
+    source_dir = os.path.join(work_dir, "Source")
+    dotstar.STAGING_DIRECTORY = os.path.join(work_dir, "Staging")
+    dotstar.TRASH_DIRECTORY = os.path.join(work_dir, "Trash")
+    dotstar.LOCKS_DIRECTORY = os.path.join(work_dir, "Locks")
+    dotstar.schedule_emptying_trash = lambda: None
+
+    # (name, required function, required parameter, function, setup),
+    # baselines need no DotStar function
+    benchmarks = [
+        ("hash .star", "get_file_hash", None,
+         lambda: dotstar.get_file_hash(archive_path), None),
+        ("hash baseline", None, None,
+         lambda: baseline_hash(archive_path), None),
+        ("extract .star", "decompress_file", None,
+         lambda: dotstar.decompress_file(archive_path, extract_dir),
+         lambda: shutil.rmtree(extract_dir, ignore_errors=True)),
+        ("extract baseline", None, None,
+         lambda: baseline_extract(archive_path, baseline_dir),
+         lambda: shutil.rmtree(baseline_dir, ignore_errors=True)),
+        ("install copy", "install_directory", None,
+         lambda: dotstar.install_directory(extract_dir, installation_dir), None),
+        ("copy baseline", None, None,
+         lambda: shutil.copytree(extract_dir, baseline_dir),
+         lambda: shutil.rmtree(baseline_dir, ignore_errors=True)),
+        ("install move", "install_directory", "move",
+         lambda: dotstar.install_directory(source_dir, installation_dir, move=True),
+         lambda: shutil.copytree(extract_dir, source_dir))
+    ]
+
+    results = []
+    for name, function_name, parameter, function, setup in benchmarks:
+        if function_name is None or is_supported(dotstar, function_name, parameter):
+            results.append((name,) + measure(function, repeat, setup=setup))
+        else:
+            results.append((name, None, None, None))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="IOBenchmark",
+                                     description="Benchmark DotStar's file handling")
+    parser.add_argument("--dotstar", default=DOTSTAR_SCRIPT,
+                        help="DotStar.py to benchmark (to compare versions)")
+    parser.add_argument("--size", type=int, default=512,
+                        help="Size of the large file in the package in MB")
+    parser.add_argument("--small-files", type=int, default=2000,
+                        help="Number of small files in the package")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="Number of runs per benchmark (the best is reported)")
+    parser.add_argument("-d", "--directory",
+                        help="Folder to run in (default: a new temporary folder)")
+    result = parser.parse_args()
+
+    dotstar = load_dotstar(result.dotstar)
+    work_dir = tempfile.mkdtemp(prefix="DotStarIOBenchmark", dir=result.directory)
+    try:
+        _, archive_path = generate_package(work_dir, result.size * 1024 * 1024,
+                                           result.small_files)
+        print("%-17s %10s %10s %10s" % ("Benchmark", "Wall [s]", "User [s]", "System [s]"))
+        for name, wall, user, system in run_benchmarks(dotstar, work_dir, archive_path,
+                                                       result.repeat):
+            if wall is None:
+                print("%-17s %10s %10s %10s" % (name, "n/a", "n/a", "n/a"))
+            else:
+                print("%-17s %10.3f %10.3f %10.3f" % (name, wall, user, system))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
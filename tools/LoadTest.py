@@ -0,0 +1,322 @@
+"""
+Load test for DotStar: starts a local stand-in repository server
+and drives many concurrent DotStar clients against it
+"""
+
+# IMPORTS
+import sys
+import os
+import io
+import json
+import math
+import time
+import shutil
+import tempfile
+import zipfile
+import logging
+import argparse
+import threading
+import subprocess
+import socketserver
+import concurrent.futures
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# CONSTANTS
+DOTSTAR_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                              "DotStar", "DotStar.py")
+OPERATIONS = ["refresh", "search", "install", "uninstall"]
+
+# VARIABLES
+bytes_served = 0
+bytes_served_lock = threading.Lock()
+
+def generate_package(name, size):
+    """
+    Returns the bytes of a .star file with the given
+    name and roughly size bytes of content
+    """
+    package_info = {
+        "DotStar Information": {"Version": "0.0.1"},
+        "Package Information":
+        {
+            "Name": name,
+            "Friendly Name": name,
+            "Description": "Generated load test package",
+            "Version": "1.0.0"
+        }
+    }
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as z:
+        z.writestr("Package.yml", json.dumps(package_info))
+        z.writestr("Content.bin", os.urandom(size))
+    return archive.getvalue()
+
+def generate_catalog(base_urls, catalog_size, package_count):
+    """
+    Returns a repository listing catalog_size packages. Every
+    package is served by every server, the first one being the
+    main URL and the others mirrors.
+    """
+    packages = []
+    for index in range(catalog_size):
+        file_name = "/Packages/loadtest" + str(index % package_count) + ".star"
+        packages.append({
+            "Name": "loadtest" + str(index),
+            "Version": "1.0.0",
+            "URL": base_urls[0] + file_name,
+            "Mirrors": [base_url + file_name for base_url in base_urls[1:]]
+        })
+    # JSON is valid YAML, so DotStar can read it as-is
+    return json.dumps({"Packages": packages}).encode("utf-8")
+
+class RepositoryRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the generated catalog and packages with
+    the configured latency and bandwidth
+    """
+    def do_GET(self):
+        """
+        Handles GET requests
+        """
+        time.sleep(self.server.latency)
+        if self.path == "/Master.yml":
+            content = self.server.catalog
+        elif self.path.startswith("/Packages/") and self.path[10:] in self.server.packages:
+            content = self.server.packages[self.path[10:]]
+        else:
+            self.send_error(404)
+            return
+
+        start, end = 0, len(content) - 1
+        byte_range = self.headers.get("Range", "")
+        if byte_range.startswith("bytes=") and "-" in byte_range:
+            first, last = byte_range[6:].split("-", 1)
+            start = int(first or 0)
+            end = min(end, int(last)) if last else end
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.send_throttled(memoryview(content)[start:end + 1])
+
+    def do_HEAD(self):
+        """
+        Handles HEAD requests
+        """
+        self.do_GET()
+
+    def send_throttled(self, content):
+        """
+        Sends the content no faster than the bandwidth limit
+        """
+        global bytes_served
+        chunk_size = 64 * 1024
+        for offset in range(0, len(content), chunk_size):
+            chunk = content[offset:offset + chunk_size]
+            self.wfile.write(chunk)
+            with bytes_served_lock:
+                bytes_served += len(chunk)
+            if self.server.bandwidth:
+                time.sleep(len(chunk) / self.server.bandwidth)
+
+    def log_message(self, format, *args):
+        pass
+
+class RepositoryServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each request in its own thread
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+def start_repository_servers(count, packages, catalog_size, latency, bandwidth):
+    """
+    Starts count repository servers on free local ports,
+    all serving the same packages, and returns them
+    """
+    servers = []
+    for _ in range(count):
+        server = RepositoryServer(("127.0.0.1", 0), RepositoryRequestHandler)
+        server.packages = packages
+        server.latency = latency
+        server.bandwidth = bandwidth
+        servers.append(server)
+    base_urls = ["http://127.0.0.1:%d" % server.server_address[1] for server in servers]
+    catalog = generate_catalog(base_urls, catalog_size, len(packages))
+    for server in servers:
+        server.catalog = catalog
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return servers
+
+def create_client(client_dir, repository_url):
+    """
+    Sets up a DotStar installation in client_dir
+    using only the given repository
+    """
+    os.makedirs(client_dir, exist_ok=True)
+    shutil.copy(DOTSTAR_SCRIPT, client_dir)
+    client_settings = {
+        "Repositories": [repository_url],
+        "Security": {"Always allow running scripts": True},
+        "Logging": {"Level": "error"},
+        "Locked files": [],
+        "Temporary directory": os.path.join(client_dir, "Temp")
+    }
+    with open(os.path.join(client_dir, "DotStarSettings.yml"), "w") as settings_yaml:
+        json.dump(client_settings, settings_yaml)
+
+def run_client_operation(client_dir, operation, package_name):
+    """
+    Runs one DotStar operation and returns its duration,
+    whether it succeeded and the peak RSS in KB (None if
+    it can't be measured on this platform)
+    """
+    arguments = {
+        "refresh": ["refresh"],
+        "search": ["-s", package_name],
+        "install": ["-y", "-i", package_name],
+        "uninstall": ["-y", "-u", package_name]
+    }[operation]
+    command = [sys.executable, os.path.join(client_dir, "DotStar.py"), "-l", "error"] + arguments
+    with tempfile.TemporaryFile() as output:
+        begin = time.monotonic()
+        process = subprocess.Popen(command, cwd=client_dir, stdin=subprocess.DEVNULL,
+                                   stdout=output, stderr=subprocess.DEVNULL)
+        peak_rss = None
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            peak_rss = usage.ru_maxrss
+            if sys.platform == "darwin":
+                peak_rss //= 1024
+        else:
+            process.wait()
+        duration = time.monotonic() - begin
+        output.seek(0)
+        printed = output.read().decode("utf-8", errors="replace")
+
+    installed_dir = os.path.join(client_dir, "Packages", "Installed", package_name)
+    success = process.returncode == 0 and {
+        "refresh": lambda: os.path.exists(os.path.join(client_dir, "Repositories", "Repo0.star")),
+        "search": lambda: package_name in printed,
+        "install": lambda: os.path.isdir(installed_dir),
+        "uninstall": lambda: not os.path.exists(installed_dir)
+    }[operation]()
+    return duration, success, peak_rss
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile of the values
+    """
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def run_phase(clients, operation, parallel_clients):
+    """
+    Runs the operation on all clients concurrently
+    and returns its statistics
+    """
+    bytes_before = bytes_served
+    begin = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(parallel_clients) as executor:
+        results = list(executor.map(lambda client: run_client_operation(client[0], operation,
+                                                                       client[1]),
+                                    clients))
+    elapsed = time.monotonic() - begin
+    durations = [duration for duration, _, _ in results]
+    rss_values = [rss for _, _, rss in results if rss is not None]
+    return {
+        "Operation": operation,
+        "Count": len(results),
+        "Failures": sum(1 for _, success, _ in results if not success),
+        "Throughput": len(results) / elapsed,
+        "P50": percentile(durations, 0.5),
+        "P99": percentile(durations, 0.99),
+        "Bytes": bytes_served - bytes_before,
+        "Peak RSS": max(rss_values) if rss_values else None
+    }
+
+def print_report(phases, total_elapsed):
+    """
+    Prints the statistics of all phases as a table
+    """
+    print("%-10s %6s %6s %10s %9s %9s %12s %12s" %
+          ("Operation", "Count", "Failed", "Ops/s", "p50 [s]", "p99 [s]", "Bytes", "Peak RSS"))
+    for phase in phases:
+        peak_rss = "-" if phase["Peak RSS"] is None else str(phase["Peak RSS"]) + " KB"
+        print("%-10s %6d %6d %10.2f %9.3f %9.3f %12d %12s" %
+              (phase["Operation"], phase["Count"], phase["Failures"], phase["Throughput"],
+               phase["P50"], phase["P99"], phase["Bytes"], peak_rss))
+    print("Total: %.2f s, %d bytes transferred" %
+          (total_elapsed, sum(phase["Bytes"] for phase in phases)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="LoadTest",
+                                     description="Load test DotStar against a local repository")
+    parser.add_argument("-c", "--clients", type=int, default=8,
+                        help="Number of concurrent DotStar clients")
+    parser.add_argument("-p", "--packages", type=int, default=4,
+                        help="Number of distinct generated packages")
+    parser.add_argument("--package-size", type=int, default=1024,
+                        help="Size of each package in KB")
+    parser.add_argument("--catalog-size", type=int, default=100,
+                        help="Number of entries in the generated catalog")
+    parser.add_argument("-m", "--mirrors", type=int, default=1,
+                        help="Number of servers serving every package")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Latency added to every request in milliseconds")
+    parser.add_argument("--bandwidth", type=int, default=0,
+                        help="Bandwidth limit per connection in KB/s (0 = unlimited)")
+    parser.add_argument("--shared", action="store_true",
+                        help="Let all clients share one DotStar installation")
+    parser.add_argument("-o", "--operations", default=",".join(OPERATIONS),
+                        help="Comma-separated operations to run, in order")
+    parser.add_argument("--json", help="Also write the results as JSON into this file")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the client directories afterwards")
+    result = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    operations = [operation for operation in result.operations.split(",") if operation]
+    for operation in operations:
+        if operation not in OPERATIONS:
+            parser.error("unknown operation " + operation)
+    result.catalog_size = max(result.catalog_size, result.packages)
+
+    logging.info("Generating %d packages of %d KB", result.packages, result.package_size)
+    packages = {"loadtest" + str(index) + ".star": generate_package("loadtest" + str(index),
+                                                                    result.package_size * 1024)
+                for index in range(result.packages)}
+    servers = start_repository_servers(max(1, result.mirrors), packages, result.catalog_size,
+                                       result.latency / 1000, result.bandwidth * 1024)
+    repository_url = "http://127.0.0.1:%d/Master.yml" % servers[0].server_address[1]
+
+    work_dir = tempfile.mkdtemp(prefix="DotStarLoadTest")
+    clients = []
+    for index in range(result.clients):
+        client_dir = os.path.join(work_dir, "Shared" if result.shared else "Client" + str(index))
+        if not os.path.exists(client_dir):
+            create_client(client_dir, repository_url)
+        clients.append((client_dir, "loadtest" + str(index % result.packages)))
+    logging.info("Running %d clients in %s", result.clients, work_dir)
+
+    phases = []
+    begin = time.monotonic()
+    for operation in operations:
+        phases.append(run_phase(clients, operation, result.clients))
+        logging.info("Finished %s", operation)
+    total_elapsed = time.monotonic() - begin
+
+    for server in servers:
+        server.shutdown()
+    print_report(phases, total_elapsed)
+    if result.json:
+        with open(result.json, "w") as results_json:
+            json.dump({"Phases": phases, "Total seconds": total_elapsed}, results_json, indent=2)
+    if not result.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)